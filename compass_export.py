@@ -3,7 +3,7 @@ __author__ = "Chris Frankowski"
 __email__ = "chris.frankowski@rwdi.com"
 __version__ = "2023.0.0"
 
-import iesve, json, os
+import functools, iesve, json, os, sys
 import numpy as np
 from datetime import datetime, timezone
 from pathlib import Path
@@ -22,6 +22,9 @@ VE_VERSION_MINOR = int(
 
 
 def export():
+    # construction data may have changed since a previous run
+    get_constructions_db.cache_clear()
+    get_construction_info.cache_clear()
     proposed_inputs = get_user_inputs("Proposed")
     proposed_results = get_results(proposed_inputs, "Proposed")
 
@@ -141,6 +144,7 @@ def get_energy(aps_file):
     print("Gathering Energy Uses...", end="")
     energy_uses = aps_file.get_energy_uses()
     energy_sources = aps_file.get_energy_sources()
+    hours_per_result = 24 / aps_file.results_per_day
     energy_uses_export = {}
     for use_k, use_v in energy_uses.items():
         energy_sources_export = {}
@@ -148,14 +152,17 @@ def get_energy(aps_file):
             result = aps_file.get_energy_results(use_id=use_k, source_id=source_k)
             energy_usage = np.sum(result)
             if energy_usage:
-                energy_usage = energy_usage * (24 / aps_file.results_per_day) / 1000
+                energy_usage = energy_usage * hours_per_result / 1000
                 demand = np.max(result)
+                # The series stays nested under its source: EnergyCompass.design
+                # reads it from here, and json.dumps encodes it in C regardless of
+                # nesting depth
                 energy_sources_export[str(source_k)] = {
                     "name": source_v["name"],
                     "cef": source_v["cef"],
                     "usage": energy_usage,
                     "demand": demand / 1000,
-                    "all": [round(float(r), 2) for r in result],
+                    "all": np.round(result.astype(np.float64), 2),
                 }
         energy_uses_export[str(use_k)] = {
             "name": use_v["name"],
@@ -189,8 +196,10 @@ def get_weather(aps_file):
     else:
         temps = aps_file.get_weather_results("Temperature", "Dry-bulb temperature")
 
-    hdd = sum([max(HDD_REF - temp, 0) for temp in temps]) / aps_file.results_per_day
-    cdd = sum([max(temp - HDD_REF, 0) for temp in temps]) / aps_file.results_per_day
+    results_per_day = aps_file.results_per_day
+    temps = np.asarray(temps, dtype=np.float64)
+    hdd = float(np.maximum(HDD_REF - temps, 0).sum()) / results_per_day
+    cdd = float(np.maximum(temps - HDD_REF, 0).sum()) / results_per_day
     print("DONE")
     return {"heating_degree_days": hdd, "cooling_degree_days": cdd}
 
@@ -205,6 +214,78 @@ def get_location():
     return data
 
 
+BODY_AREAS_KEY_MAP = (
+    ("int_floor_area", "ifa"),
+    ("int_floor_glazed", "ifg"),
+    ("int_floor_opening", "ifo"),
+    ("int_ceiling_area", "ica"),
+    ("int_ceiling_glazed", "icg"),
+    ("int_ceiling_opening", "ico"),
+    ("int_ceiling_door", "icd"),
+    ("int_wall_area", "iwa"),
+    ("int_wall_glazed", "iwg"),
+    ("int_wall_opening", "iwo"),
+    ("int_wall_door", "iwd"),
+    ("ext_floor_area", "efa"),
+    ("ext_floor_glazed", "efg"),
+    ("ext_floor_opening", "efo"),
+    ("ext_ceiling_area", "eca"),
+    ("ext_ceiling_glazed", "ecg"),
+    ("ext_ceiling_opening", "eco"),
+    ("ext_ceiling_door", "ecd"),
+    ("ext_wall_area", "ewa"),
+    ("ext_wall_glazed", "ewg"),
+    ("ext_wall_opening", "ewo"),
+    ("ext_wall_door", "ewd"),
+    ("volume", "v"),
+)
+
+ADJACENCIES_KEY_MAP = (
+    ("gross", "g"),
+    ("hole", "h"),
+    ("door", "d"),
+    ("window", "w"),
+)
+
+AREAS_KEY_MAP = (
+    ("total_gross", "tg"),
+    ("total_net", "tn"),
+    ("total_window", "tw"),
+    ("total_door", "td"),
+    ("total_hole", "th"),
+    ("total_gross_openings", "tgo"),
+    ("internal_gross", "ig"),
+    ("internal_net", "in"),
+    ("internal_window", "iw"),
+    ("internal_door", "id"),
+    ("internal_hole", "ih"),
+    ("internal_gross_openings", "igo"),
+    ("external_gross", "eg"),
+    ("external_net", "en"),
+    ("external_window", "ew"),
+    ("external_door", "ed"),
+    ("external_hole", "eh"),
+    ("external_gross_openings", "ego"),
+)
+
+OPENING_TOTALS_KEY_MAP = (
+    ("openings", "o"),
+    ("holes", "h"),
+    ("doors", "d"),
+    ("windows", "w"),
+    ("external_holes", "eh"),
+    ("external_doors", "ed"),
+    ("external_windows", "ew"),
+)
+
+PROPERTIES_KEY_MAP = (
+    ("type", "ty"),
+    ("area", "a"),
+    ("orientation", "o"),
+    ("tilt", "ti"),
+)
+
+
 def get_bodies(model_type):
     ve_project = iesve.VEProject.get_current_project()
     if model_type == "Proposed":
@@ -224,32 +305,7 @@ def get_bodies(model_type):
     for body_i, body in enumerate(bodies):
         body_constructions = [c[0] for c in body.get_assigned_constructions()]
         body_areas = body.get_areas()
-        body_areas_key_map = [
-            ("int_floor_area", "ifa"),
-            ("int_floor_glazed", "ifg"),
-            ("int_floor_opening", "ifo"),
-            ("int_ceiling_area", "ica"),
-            ("int_ceiling_glazed", "icg"),
-            ("int_ceiling_opening", "ico"),
-            ("int_ceiling_door", "icd"),
-            ("int_wall_area", "iwa"),
-            ("int_wall_glazed", "iwg"),
-            ("int_wall_opening", "iwo"),
-            ("int_wall_door", "iwd"),
-            ("ext_floor_area", "efa"),
-            ("ext_floor_glazed", "efg"),
-            ("ext_floor_opening", "efo"),
-            ("ext_ceiling_area", "eca"),
-            ("ext_ceiling_glazed", "ecg"),
-            ("ext_ceiling_opening", "eco"),
-            ("ext_ceiling_door", "ecd"),
-            ("ext_wall_area", "ewa"),
-            ("ext_wall_glazed", "ewg"),
-            ("ext_wall_opening", "ewo"),
-            ("ext_wall_door", "ewd"),
-            ("volume", "v"),
-        ]
-        body_areas = reduce_dict(body_areas, body_areas_key_map)
+        body_areas = reduce_dict(body_areas, BODY_AREAS_KEY_MAP)
 
         surfaces = body.get_surfaces()
         surface_output = []
@@ -257,70 +313,30 @@ def get_bodies(model_type):
         pb_update(body_i, len(bodies))
         for sur in surfaces:
             adjacencies = sur.get_adjacencies()
-            adjacencies_key_map = [
-                ("gross", "g"),
-                ("hole", "h"),
-                ("door", "d"),
-                ("window", "w"),
-            ]
             adjacency_output = []
+            adjacency_constructions = []
             for adjacency in adjacencies:
                 adjacency_properties = adjacency.get_properties()
                 adjacency_properties = reduce_dict(
-                    adjacency_properties, adjacencies_key_map
+                    adjacency_properties, ADJACENCIES_KEY_MAP
                 )
                 adjacency_construction = adjacency.get_construction()
                 adjacency_properties["c"] = adjacency_construction
-                constructions_set.add(adjacency_construction)
+                adjacency_constructions.append(adjacency_construction)
                 adjacency_output.append(adjacency_properties)
+            constructions_set.update(adjacency_constructions)
 
             areas = sur.get_areas()
-            areas_key_map = [
-                ("total_gross", "tg"),
-                ("total_net", "tn"),
-                ("total_window", "tw"),
-                ("total_door", "td"),
-                ("total_hole", "th"),
-                ("total_gross_openings", "tgo"),
-                ("internal_gross", "ig"),
-                ("internal_net", "in"),
-                ("internal_window", "iw"),
-                ("internal_door", "id"),
-                ("internal_hole", "ih"),
-                ("internal_gross_openings", "igo"),
-                ("external_gross", "eg"),
-                ("external_net", "en"),
-                ("external_window", "ew"),
-                ("external_door", "ed"),
-                ("external_hole", "eh"),
-                ("external_gross_openings", "ego"),
-            ]
-            areas = reduce_dict(areas, areas_key_map)
+            areas = reduce_dict(areas, AREAS_KEY_MAP)
 
             constructions = sur.get_constructions()
-            for c in constructions:
-                constructions_set.add(c)
+            constructions_set.update(constructions)
 
             opening_totals = sur.get_opening_totals()
-            opening_totals_key_map = [
-                ("openings", "o"),
-                ("holes", "h"),
-                ("doors", "d"),
-                ("windows", "w"),
-                ("external_holes", "eh"),
-                ("external_doors", "ed"),
-                ("external_windows", "ew"),
-            ]
-            opening_totals = reduce_dict(opening_totals, opening_totals_key_map)
+            opening_totals = reduce_dict(opening_totals, OPENING_TOTALS_KEY_MAP)
 
             properties = sur.get_properties()
-            properties_key_map = [
-                ("type", "ty"),
-                ("area", "a"),
-                ("orientation", "o"),
-                ("tilt", "ti"),
-            ]
-            properties = reduce_dict(properties, properties_key_map)
+            properties = reduce_dict(properties, PROPERTIES_KEY_MAP)
 
             surface_output.append(
                 {
@@ -342,100 +358,54 @@ def get_bodies(model_type):
             }
         )
 
-    # get the Project (type=0) tuple (this is what we are normally interested in, the project list associated with the VE model)
-    # this tuple will always have a project list of length 1, the only project associated with the VE model
     constructions_output = {}
-    constructions_db = iesve.VECdbDatabase.get_current_database().get_projects()[0][0]
-
     for c in constructions_set:
-        construction = constructions_db.get_construction(
-            c, iesve.construction_class.none
-        )
-        u_value = construction.get_u_factor(iesve.uvalue_types.ashrae)
-        g_values = construction.get_g_values()
-
-        constructions_output[construction.id] = {
-            "category": str(construction.category),
-            "u_value": round(u_value, 6),
-            "g_values": g_values,
-            "reference": construction.reference,
-        }
+        construction_id, construction_info = get_construction_info(c)
+        constructions_output[construction_id] = construction_info
 
     wwr = iesve.VEGeometry.get_wwr()
 
     return {"constructions": constructions_output, "bodies": bodies_output, "wwr": wwr}
 
 
+@functools.lru_cache(maxsize=None)
+def get_constructions_db():
+    # get the Project (type=0) tuple (this is what we are normally interested in, the project list associated with the VE model)
+    # this tuple will always have a project list of length 1, the only project associated with the VE model
+    return iesve.VECdbDatabase.get_current_database().get_projects()[0][0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_construction_info(construction_id):
+    construction = get_constructions_db().get_construction(
+        construction_id, iesve.construction_class.none
+    )
+    u_value = construction.get_u_factor(iesve.uvalue_types.ashrae)
+    g_values = construction.get_g_values()
+
+    return construction.id, {
+        "category": str(construction.category),
+        "u_value": round(u_value, 6),
+        "g_values": g_values,
+        "reference": construction.reference,
+    }
+
+
 def get_room_results(aps_file):
     room_list = aps_file.get_room_list()
-    result_length = (
-        aps_file.last_day - aps_file.first_day + 1
-    ) * aps_file.results_per_day
+    first_day, last_day = aps_file.first_day, aps_file.last_day
+    result_length = (last_day - first_day + 1) * aps_file.results_per_day
 
-    heat_excluding_oa = np.zeros(result_length)
-    cool_excluding_oa = np.zeros(result_length)
+    heat_excluding_oa = np.zeros(result_length, dtype=np.float64)
+    cool_excluding_oa = np.zeros(result_length, dtype=np.float64)
+    total_gain = np.empty(result_length, dtype=np.float64)  # reused for every room
 
     print("Gathering Room Results")
     pb_header()
     for room_i, room in enumerate(room_list):
         pb_update(room_i, len(room_list))
-
-        if VE_VERSION_MAJOR == 2017:
-            internal_gain = aps_file.get_room_results(
-                room[1], "Internal gain", "z"
-            ) + aps_file.get_room_results(room[1], "Internal latent gain", "z")
-            solar_gain = aps_file.get_room_results(room[1], "Solar gain", "z")
-            infiltration_gain = aps_file.get_room_results(
-                room[1], "Infiltration gain", "z"
-            )
-            infiltration_gain_lat = aps_file.get_room_results(
-                room[1], "Infiltration lat gain", "z"
-            )
-            if infiltration_gain_lat is not None:
-                infiltration_gain += infiltration_gain_lat
-            external_conduction_gain = aps_file.get_room_results(
-                room[1], "External conduction gain", "z"
-            )
-            internal_conduction_gain = aps_file.get_room_results(
-                room[1], "Internal conduction gain", "z"
-            )
-        else:
-            internal_gain = aps_file.get_room_results(
-                room[1], "Casual gains", "Internal gain", "z"
-            ) + aps_file.get_room_results(
-                room[1], "Internal latent gain", "Internal latent gain", "z"
-            )
-            solar_gain = aps_file.get_room_results(
-                room[1], "Window solar gains", "Solar gain", "z"
-            )
-            infiltration_gain = aps_file.get_room_results(
-                room[1], "Infiltration gain", "Infiltration gain", "z"
-            )
-            infiltration_gain_lat = aps_file.get_room_results(
-                room[1], "Infiltration lat gain", "Infiltration lat gain", "z"
-            )
-            if infiltration_gain_lat is not None:
-                infiltration_gain += infiltration_gain_lat
-            external_conduction_gain = aps_file.get_room_results(
-                room[1], "Conduction from ext elements", "External conduction gain", "z"
-            )
-            internal_conduction_gain = aps_file.get_room_results(
-                room[1], "Conduction from int surfaces", "Internal conduction gain", "z"
-            )
-
-        total_gain = (
-            internal_gain
-            + solar_gain
-            + infiltration_gain
-            + external_conduction_gain
-            + internal_conduction_gain
-        )
-
-        for i, v in enumerate(total_gain):
-            if v > 0:
-                cool_excluding_oa[i] += -v / 1000
-            elif v < 0:
-                heat_excluding_oa[i] += -v / 1000
+        get_room_gain(aps_file, room, total_gain)
+        split_gains(total_gain, heat_excluding_oa, cool_excluding_oa)
 
     return {
         "heat_excluding_oa": max(heat_excluding_oa),
@@ -443,39 +413,91 @@ def get_room_results(aps_file):
     }
 
 
+def get_room_gain(aps_file, room, total_gain):
+    if VE_VERSION_MAJOR == 2017:
+        internal_gain = aps_file.get_room_results(room[1], "Internal gain", "z")
+        internal_gain_lat = aps_file.get_room_results(
+            room[1], "Internal latent gain", "z"
+        )
+        solar_gain = aps_file.get_room_results(room[1], "Solar gain", "z")
+        infiltration_gain = aps_file.get_room_results(room[1], "Infiltration gain", "z")
+        infiltration_gain_lat = aps_file.get_room_results(
+            room[1], "Infiltration lat gain", "z"
+        )
+        external_conduction_gain = aps_file.get_room_results(
+            room[1], "External conduction gain", "z"
+        )
+        internal_conduction_gain = aps_file.get_room_results(
+            room[1], "Internal conduction gain", "z"
+        )
+    else:
+        internal_gain = aps_file.get_room_results(
+            room[1], "Casual gains", "Internal gain", "z"
+        )
+        internal_gain_lat = aps_file.get_room_results(
+            room[1], "Internal latent gain", "Internal latent gain", "z"
+        )
+        solar_gain = aps_file.get_room_results(
+            room[1], "Window solar gains", "Solar gain", "z"
+        )
+        infiltration_gain = aps_file.get_room_results(
+            room[1], "Infiltration gain", "Infiltration gain", "z"
+        )
+        infiltration_gain_lat = aps_file.get_room_results(
+            room[1], "Infiltration lat gain", "Infiltration lat gain", "z"
+        )
+        external_conduction_gain = aps_file.get_room_results(
+            room[1], "Conduction from ext elements", "External conduction gain", "z"
+        )
+        internal_conduction_gain = aps_file.get_room_results(
+            room[1], "Conduction from int surfaces", "Internal conduction gain", "z"
+        )
+
+    np.add(internal_gain, internal_gain_lat, out=total_gain)
+    np.add(total_gain, solar_gain, out=total_gain)
+    np.add(total_gain, infiltration_gain, out=total_gain)
+    if infiltration_gain_lat is not None:
+        np.add(total_gain, infiltration_gain_lat, out=total_gain)
+    np.add(total_gain, external_conduction_gain, out=total_gain)
+    np.add(total_gain, internal_conduction_gain, out=total_gain)
+
+    return total_gain
+
+
+def split_gains(total_gain, heat, cool):
+    # Gains (W) are scaled to kW in place, then positive gains are removed as cooling
+    # and negative gains as heating without allocating temporary value arrays
+    np.divide(total_gain, 1000, out=total_gain)
+    np.subtract(cool, total_gain, out=cool, where=total_gain > 0)
+    np.subtract(heat, total_gain, out=heat, where=total_gain < 0)
+
+
 def get_building_results(aps_file):
     print("Gathering Building Results...")
     variables = aps_file.get_variables()
     results = {}
 
+    power_types = {"Power", "Sys Load"}
+    variables = [var for var in variables if var["units_type"] in power_types]
+    if not variables:
+        return results
+
     pb_header()
     for i, var in enumerate(variables):
         pb_update(i, len(variables))
-        if var["units_type"] in ["Power", "Sys Load"]:
-            if VE_VERSION_MAJOR == 2017:
-                total = np.sum(
-                    aps_file.get_results(var["aps_varname"], var["model_level"])
-                )
-                peak = np.max(
-                    aps_file.get_results(var["aps_varname"], var["model_level"])
-                )
-            else:
-                total = np.sum(
-                    aps_file.get_results(
-                        var["aps_varname"], var["display_name"], var["model_level"]
-                    )
-                )
-                peak = np.max(
-                    aps_file.get_results(
-                        var["aps_varname"], var["display_name"], var["model_level"]
-                    )
-                )
+        if VE_VERSION_MAJOR == 2017:
+            var_results = aps_file.get_results(var["aps_varname"], var["model_level"])
+        else:
+            var_results = aps_file.get_results(
+                var["aps_varname"], var["display_name"], var["model_level"]
+            )
 
-            if total:
-                results[var["aps_varname"]] = {
-                    "total": float(total),
-                    "peak": float(peak),
-                }
+        total = float(np.sum(var_results))
+        if total:
+            results[var["aps_varname"]] = {
+                "total": total,
+                "peak": float(np.max(var_results)),
+            }
 
     return results
 
@@ -566,33 +588,29 @@ def get_airflows(aps_file, room_nodes, oa_intake_nodes):
         pb_update(i, len(oa_intake_nodes))
         oa_results.append(ghnr(aps_file, oa_intake))
 
+    seconds_per_result = 3600 * (24 / aps_file.results_per_day)
+    room_results = [room for room in room_results if room is not None]
+    oa_results = [oa for oa in oa_results if oa is not None]
+
     room_grand_total = 0
     room_hourly_total = None
     oa_grand_total = 0
     oa_hourly_total = None
 
-    for room in room_results:
-        if room is not None:
-            if room_hourly_total is None:
-                room_hourly_total = room
-            else:
-                room_hourly_total += room
-            room_grand_total += sum(room) * (3600 * (24 / aps_file.results_per_day))
+    if room_results:
+        room_hourly_total = np.stack(room_results).sum(axis=0)
+        room_grand_total = float(room_hourly_total.sum()) * seconds_per_result
 
-    for oa in oa_results:
-        if oa is not None:
-            if oa_hourly_total is None:
-                oa_hourly_total = oa
-            else:
-                oa_hourly_total += oa
-            oa_grand_total += sum(oa) * (3600 * (24 / aps_file.results_per_day))
+    if oa_results:
+        oa_hourly_total = np.stack(oa_results).sum(axis=0)
+        oa_grand_total = float(oa_hourly_total.sum()) * seconds_per_result
 
     if room_hourly_total is not None and oa_hourly_total is not None:
         return {
             "supply_air_total": float(room_grand_total),
-            "supply_air_max": float(max(room_hourly_total)),
+            "supply_air_max": float(room_hourly_total.max()),
             "outside_air_total": float(oa_grand_total),
-            "outside_air_max": float(max(oa_hourly_total)),
+            "outside_air_max": float(oa_hourly_total.max()),
         }
     else:
         return {
@@ -604,41 +622,40 @@ def get_airflows(aps_file, room_nodes, oa_intake_nodes):
 
 
 def ghnr(aps_file, node):
-    if (
-        aps_file.get_hvac_node_results(node, -1, "Volume flow") is None
-        and aps_file.get_hvac_node_results(node, 1, "Volume flow") is None
-    ):
+    plant_result = aps_file.get_hvac_node_results(node, -1, "Volume flow")
+    room_result = aps_file.get_hvac_node_results(node, 1, "Volume flow")
+    if plant_result is None and room_result is None:
         return None  # Node doesn't exist
-    elif aps_file.get_hvac_node_results(node, -1, "Volume flow") is not None:
-        return aps_file.get_hvac_node_results(
-            node, -1, "Volume flow"
-        )  # Node is a plant side node
+    elif plant_result is not None:
+        return plant_result  # Node is a plant side node
     else:
         layer = 1
-        total = aps_file.get_hvac_node_results(node, 1, "Volume flow")
+        total = room_result.copy()  # accumulate without mutating reader output
         while True:
             layer += 1
             result = aps_file.get_hvac_node_results(node, layer, "Volume flow")
             if result is None:
                 break
             else:
-                total += result
+                np.add(total, result, out=total)
         return total
 
 
 def pb_header():
-    global _threshold
-    _threshold = 0.01
-    print("[" + "progress".center(100) + "]\n[", end="")
+    global _ticks
+    _ticks = 0
+    print("[" + "progress".center(PROGRESS_BAR_WIDTH) + "]\n[", end="")
 
 
 def pb_update(index, length):
-    global _threshold
-    while round(((index + 1) / length), 3) >= round(_threshold, 3):
-        print("X", end="")
-        _threshold += 0.01
+    global _ticks
+    ticks = (index + 1) * PROGRESS_BAR_WIDTH // length
+    if ticks > _ticks:
+        sys.stdout.write("X" * (ticks - _ticks))  # left buffered until the bar ends
+        _ticks = ticks
     if index + 1 == length:
-        print("]")
+        sys.stdout.write("]\n")
+        sys.stdout.flush()
 
 
 def get_node_list(root, title, model_type, prompt_text):
@@ -651,7 +668,9 @@ def get_node_list(root, title, model_type, prompt_text):
 
         if nodes:
             try:
-                result = [int(node.strip()) for node in nodes.split(",") if node]
+                result = sorted(
+                    {int(node) for node in nodes.split(",") if node.strip()}
+                )
                 print(title + ": " + str(result))
                 return result
             except:
@@ -676,11 +695,11 @@ def cost_input(root, title, model_type, prompt_text):
 def reduce_dict(full_dict, key_map):
     new_dict = {}
     for lk, sk in key_map:
-        if full_dict[lk] != 0:
-            try:
-                new_dict[sk] = round(full_dict[lk], 2)
-            except TypeError:
-                new_dict[sk] = full_dict[lk]
+        value = full_dict[lk]
+        if value != 0:
+            if isinstance(value, (int, float, np.number)):
+                value = round(value, 2)
+            new_dict[sk] = value
     return new_dict
 
 
@@ -701,11 +720,22 @@ def write_file(export_data, suffix):
 
     root.destroy()
 
+    # json.dumps uses the C encoder, json.dump falls back to the pure Python one
     with open(file_path, "w") as export_file:
-        json.dump(export_data, export_file)
+        export_file.write(json.dumps(export_data, default=json_default))
     print("Export created: " + file_path)
 
 
+def json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(
+        "Object of type " + type(obj).__name__ + " is not JSON serializable"
+    )
+
+
 if __name__ == "__main__":
     if iesve.VEProject.get_current_project().name == "Untitled":
         print("Please open the project before running the export script.")